@@ -1,14 +1,97 @@
 from pynput.keyboard import Key, Controller
-from time import sleep
-import socket, select
+from time import sleep, monotonic, perf_counter_ns, time_ns
+import argparse, logging, signal, socket, select, struct
+from collections import OrderedDict
 
 output_keyboard = Controller()
 
 IP = "82.130.61.209"
 PORT = 55555
+# Seconds without packets after which the link is considered dead and
+# all keys are released. It must be longer than the --heartbeat-max of
+# the senders, which is one second by default.
+LINK_TIMEOUT = 3.0
+
+parser = argparse.ArgumentParser(description="Press the keys sent by send.py.")
+parser.add_argument("--bind", metavar="IP",
+  help="Address to listen on, 0.0.0.0 for broadcasts (default: {}, or "
+       "all addresses with --group)".format(IP))
+parser.add_argument("--port", type=int, default=PORT,
+  help="UDP port to listen on (default: %(default)s)")
+parser.add_argument("--group", action="append", default=[], metavar="GROUP",
+  help="Join a multicast group, can be given several times")
+parser.add_argument("--interface", default="0.0.0.0", metavar="IP",
+  help="Address of the interface to join the groups on (default: any)")
+parser.add_argument("--rcvbuf", type=int, metavar="BYTES",
+  help="Size of the socket receive buffer (default: set by the system)")
+parser.add_argument("--log-level", default="info",
+  choices=("debug", "info", "warning", "error"),
+  help="Least important messages to show, debug shows every packet and key "
+       "(default: %(default)s)")
+parser.add_argument("--log-rate", type=int, default=10, metavar="COUNT",
+  help="Most messages of the same kind to show per second "
+       "(default: %(default)s)")
+parser.add_argument("--link-timeout", type=float, default=LINK_TIMEOUT,
+  metavar="SECONDS",
+  help="Release all keys after SECONDS without packets. Must be longer than "
+       "the --heartbeat-max of the senders, or held keys are released "
+       "between heartbeats. (default: %(default)s)")
+options = parser.parse_args()
+if options.link_timeout <= 0:
+  parser.error("--link-timeout must be positive")
+
+
+class RateLimitFilter(logging.Filter):
+  """Lets through at most rate records per second of every message format,
+  see sender/log.py."""
+
+  def __init__(self, rate):
+    super().__init__()
+    self.rate = rate
+    self.counts = {}
+
+  def filter(self, record):
+    now = monotonic()
+    start, passed, dropped = self.counts.get(record.msg, (now, 0, 0))
+    if now - start >= 1:
+      start, passed = now, 0
+    if passed >= self.rate:
+      self.counts[record.msg] = (start, passed, dropped + 1)
+      return False
+    self.counts[record.msg] = (start, passed + 1, 0)
+    if dropped:
+      record.msg = "{} ({} similar messages dropped)".format(record.msg,
+                                                            dropped)
+    return True
+
+
+# Per-packet messages are logged at debug level, so normal runs write
+# nothing to the terminal for them
+logger = logging.getLogger("gamepad-mux")
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+handler.addFilter(RateLimitFilter(options.log_rate))
+logger.addHandler(handler)
+logger.setLevel(options.log_level.upper())
+
+bind_ip = options.bind
+if bind_ip is None:
+  # Multicast packets are only received on a wildcard or group address
+  bind_ip = "0.0.0.0" if options.group else IP
 
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((IP, PORT))
+if options.group or bind_ip in ("", "0.0.0.0"):
+  # Let several receivers on one machine get the same multicast or
+  # broadcast packets
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+if options.rcvbuf is not None:
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options.rcvbuf)
+sock.bind((bind_ip, options.port))
+sock.setblocking(False)
+for group in options.group:
+  membership = struct.pack("4s4s", socket.inet_aton(group),
+                           socket.inet_aton(options.interface))
+  sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
 
 
 keylist = ['w','s','a','d','r','t','y','u']
@@ -20,30 +103,273 @@ keylist = ['w','s','a','d','r','t','y','u']
 keys = ['a', 'b']
 release = False
 
+# Binary packet header, the same as in sender/protocol.py. Keep the two
+# in sync, this file is deployed without the sender.
+MAGIC = b"GM"
+VERSION = 1
+header = struct.Struct("!2sBBIQH")
+KEYS_PER_CONTROLLER = 8
+
+# Number of packets before the newest one that are told apart as late or
+# duplicate. Anything older is dropped as stale.
+SEQUENCE_WINDOW = 64
+# Number of senders whose sequence numbers are remembered
+MAX_SENDERS = 64
+# Largest packet read, enough for 1024 binary or 128 ASCII controllers
+MAX_PACKET_SIZE = 1024
+
+
+def decode(data):
+  """Decode a packet into (session, sequence, timestamp, bitmasks) with one
+  UDLRABCD bitmask per controller. The timestamp is the sender's wall clock
+  time of the input in nanoseconds. Packets without the binary header are
+  taken as legacy ASCII and have no session, sequence number or
+  timestamp."""
+  if data[:len(MAGIC)] == MAGIC:
+    if len(data) < header.size:
+      return None, None, None, None
+    magic, version, session, sequence, timestamp, count = \
+      header.unpack_from(data)
+    if version != VERSION or len(data) != header.size + count:
+      return None, None, None, None
+    return session, sequence, timestamp, data[header.size:]
+
+  keys = data.decode("ascii", "replace").replace(' ', '')
+  if len(keys) % KEYS_PER_CONTROLLER:
+    return None, None, None, None
+  bitmasks = bytearray(len(keys) // KEYS_PER_CONTROLLER)
+  for i, key in enumerate(keys):
+    if key == '1':
+      bitmasks[i // KEYS_PER_CONTROLLER] |= 1 << (i % KEYS_PER_CONTROLLER)
+  return None, None, None, bitmasks
+
+
+# Latency histograms with 1% precision, see sender/latency.py
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+PERCENTILES = (50, 99, 99.9)
+
+
+class Histogram:
+  """Counts of latencies in nanoseconds in buckets of logarithmic width."""
+
+  def __init__(self):
+    self.counts = []
+    self.count = 0
+    self.max = 0
+
+  def record(self, value):
+    value = max(0, value)
+    shift = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+    index = shift * SUB_BUCKETS + (value >> shift)
+    if index >= len(self.counts):
+      self.counts.extend([0] * (index + 1 - len(self.counts)))
+    self.counts[index] += 1
+    self.count += 1
+    self.max = max(self.max, value)
+
+  def percentile(self, percent):
+    wanted = self.count * percent / 100
+    total = 0
+    for index, count in enumerate(self.counts):
+      total += count
+      if count and total >= wanted:
+        shift = max(0, index // SUB_BUCKETS - 1)
+        return ((index - shift * SUB_BUCKETS) << shift) + ((1 << shift) >> 1)
+    return 0
+
+
+# Histogram of every stage, in the order they are first used. The ones
+# measured from the input need the clocks of the sender and receiver to
+# be in sync, e.g. with NTP or PTP.
+latency = OrderedDict()
+
+
+def record_latency(stage, value):
+  if stage not in latency:
+    latency[stage] = Histogram()
+  latency[stage].record(value)
 
 
-def keypresser(keys):
-  for i in range(len(keylist)):
-    output_keyboard.release(keylist[i])
-    if keys[i] is '1':
-      print(keylist[i])
-      output_keyboard.press(keylist[i])
-  
+def latency_report():
+  lines = ["Latency:"]
+  for stage, histogram in latency.items():
+    percentiles = ", ".join("p{:g} {:.1f} us".format(
+      percent, histogram.percentile(percent) / 1000)
+      for percent in PERCENTILES)
+    lines.append("{}: {} samples, {}, max {:.1f} us".format(
+      stage, histogram.count, percentiles, histogram.max / 1000))
+  return "\n".join(lines)
 
 
+class SequenceTracker:
+  """Accepts only packets newer than anything seen from the same sender.
 
-while(1):
-  buf, e, o = select.select([sock], [],[], 0.5)
-  if len(buf) <= 1024:
-    data, addr = sock.recvfrom(1024)
-    
-    keys = data.decode("UTF-8")
-    print(keys)
-    keys = keys.replace(' ', '')
-    if len(keys) is len(keylist):
-      keypresser(keys)
+  Every sender has its own session, newest sequence number and a bitmap
+  of the SEQUENCE_WINDOW packets before it, which tells late packets apart
+  from duplicates. A new session means the sender has restarted, and
+  counting starts over. Only the MAX_SENDERS most recent senders are kept.
+  """
+
+  def __init__(self):
+    self.senders = OrderedDict()
+    self.lost = 0
+    self.reordered = 0
+    self.duplicates = 0
+    self.stale = 0
+
+  def accept(self, sender, session, sequence):
+    """Return True if the packet should be applied."""
+    state = self.senders.get(sender)
+    if state is None or state[0] != session:
+      self.remember(sender, (session, sequence, 1, 0))
+      return True
+    self.senders.move_to_end(sender)
+    _, newest, seen, age = state
+
+    # Signed distance from the newest packet, allowing for wraparound
+    delta = (sequence - newest + 0x80000000) % 0x100000000 - 0x80000000
+    if delta > 0:
+      self.lost += delta - 1
+      seen = (seen << delta | 1) & ((1 << SEQUENCE_WINDOW) - 1)
+      # age is how far back the window reaches into this session
+      age = min(age + delta, SEQUENCE_WINDOW - 1)
+      self.senders[sender] = (session, sequence, seen, age)
+      return True
+    if -delta > age:
+      # Too old to tell late from duplicate, or from before the session
+      # started and never counted as lost
+      self.stale += 1
+    elif seen & (1 << -delta):
+      self.duplicates += 1
     else:
-      print("Incorrect format")
+      # Late but not lost after all. It is still stale, so drop it.
+      self.lost -= 1
+      self.reordered += 1
+      self.senders[sender] = (session, newest, seen | (1 << -delta), age)
+    return False
+
+  def remember(self, sender, state):
+    self.senders[sender] = state
+    if len(self.senders) > MAX_SENDERS:
+      self.senders.popitem(last=False)
+
+
+# keylist split into the UDLRABCD keys of each controller
+keymap = [keylist[i:i + KEYS_PER_CONTROLLER]
+          for i in range(0, len(keylist), KEYS_PER_CONTROLLER)]
+# Bitmask of the keys currently held down for each controller
+pressed = bytearray(len(keymap))
+
+
+def keypresser(bitmasks):
+  """Press and release only the keys whose state has changed. Controllers
+  missing from the packet have all their keys released. Returns True if
+  any key was pressed or released."""
+  any_changed = False
+  for controller, keys in enumerate(keymap):
+    bitmask = bitmasks[controller] if controller < len(bitmasks) else 0
+    changed = bitmask ^ pressed[controller]
+    if changed:
+      any_changed = True
+    while changed:
+      bit = changed & -changed
+      key = keys[bit.bit_length() - 1]
+      if bitmask & bit:
+        logger.debug("Pressing %s", key)
+        output_keyboard.press(key)
+      else:
+        output_keyboard.release(key)
+      changed ^= bit
+    pressed[controller] = bitmask
+  return any_changed
+
+
+
+
+def receive_all():
+  """Read every queued packet without blocking. Returns the newest
+  accepted (timestamp, received_ns, bitmasks) of each sender, the sender of
+  the newest packet last."""
+  global coalesced
+  newest = OrderedDict()
+  while True:
+    try:
+      data, addr = sock.recvfrom(MAX_PACKET_SIZE)
+    except BlockingIOError:
+      return newest
+    received_ns = time_ns()
+    start_ns = perf_counter_ns()
+    session, sequence, timestamp, bitmasks = decode(data)
+    record_latency("decode", perf_counter_ns() - start_ns)
+    logger.debug("Received %r from %s", data, addr)
+    if sequence is not None and \
+        not sequences.accept(addr, session, sequence):
+      continue
+    if bitmasks is None:
+      logger.warning("Incorrect format from %s", addr)
+      continue
+    if addr in newest:
+      # Only the newest state matters, skip the stale one
+      coalesced += 1
+      del newest[addr]
+    newest[addr] = (timestamp, received_ns, bitmasks)
+
+
+sequences = SequenceTracker()
+last_packet = monotonic()
+# Packets skipped in favour of a newer one from the same sender
+coalesced = 0
+# The report is logged by the loop, not in the middle of whatever the
+# signal interrupted
+report_requested = False
+
+
+def request_report(signum, frame):
+  global report_requested
+  report_requested = True
+
+
+signal.signal(signal.SIGUSR1, request_report)
+
+
+def exit_on_signal(signum, frame):
+  raise SystemExit(0)
+
+
+# Report on every way out, also when killed with SIGTERM
+signal.signal(signal.SIGTERM, exit_on_signal)
+
+try:
+  while(1):
+    readable, _, _ = select.select([sock], [], [], 0.5)
+    if report_requested:
+      report_requested = False
+      logger.info("%s", latency_report())
+    if not readable:
+      if any(pressed) and monotonic() - last_packet > options.link_timeout:
+        logger.warning("No packets in %s seconds, releasing all keys",
+                       options.link_timeout)
+        keypresser(b'')
+      continue
+    last_packet = monotonic()
+    for timestamp, received_ns, bitmasks in receive_all().values():
+      start_ns = perf_counter_ns()
+      if keypresser(bitmasks):
+        # Heartbeats repeat the timestamp of their input, so only
+        # packets that change keys are measured from the input
+        record_latency("inject", perf_counter_ns() - start_ns)
+        if timestamp is not None:
+          record_latency("input to received", received_ns - timestamp)
+          record_latency("input to injection", time_ns() - timestamp)
+except KeyboardInterrupt:
+  pass
+finally:
+  logger.info("%s", latency_report())
+  logger.info("Lost %d, reordered %d, duplicate %d and too late %d "
+              "packets, skipped %d stale ones", sequences.lost,
+              sequences.reordered, sequences.duplicates, sequences.stale,
+              coalesced)
       
 
 
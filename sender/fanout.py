@@ -0,0 +1,61 @@
+"""Sending packets to many destinations from one socket.
+
+Packets are queued during a tick of the send loop and flushed together
+with sendto() on a single unconnected, non-blocking socket, so adding a
+receiver costs one system call per packet and no file descriptor. A
+destination that fails only loses its own packet and gets its error
+counted; the rest of the destinations are still sent to.
+"""
+
+from collections import Counter
+
+
+class FanOut(object):
+    """Queues (destinations, payload) pairs and sends them on flush().
+
+    Destinations are (address, port) tuples. sent and errors count the
+    packets sent to and failed for each destination, and last_errors
+    holds the most recent error of each failed destination.
+    """
+
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.sent = Counter()
+        self.errors = Counter()
+        self.last_errors = {}
+        self.__queue = []
+
+    def send(self, destinations, payload):
+        """Queue payload to be sent to all destinations."""
+        self.__queue.append((destinations, payload))
+
+    def flush(self):
+        """Send everything queued. Returns the destinations that failed
+        for the first time."""
+        sendto = self.sock.sendto
+        new_failures = []
+        for destinations, payload in self.__queue:
+            for destination in destinations:
+                try:
+                    sendto(payload, destination)
+                except OSError as error:
+                    # Refused, unreachable or a full send buffer
+                    if not self.errors[destination]:
+                        new_failures.append(destination)
+                    self.errors[destination] += 1
+                    self.last_errors[destination] = error
+                else:
+                    self.sent[destination] += 1
+        self.__queue.clear()
+        return new_failures
+
+    def report(self):
+        """Send counts of every destination that has failed, one line
+        per destination."""
+        lines = []
+        for destination, errors in self.errors.items():
+            lines.append("{}:{}: {} sent, {} failed, last error: {}".format(
+                destination[0], destination[1], self.sent[destination],
+                errors, self.last_errors[destination]))
+        return "\n".join(lines)
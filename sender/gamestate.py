@@ -0,0 +1,141 @@
+"""Compact state of any number of controllers.
+
+Every controller is a UDLRABCD bitmask byte, the same one that is sent
+over the wire, plus signed X and Y axis bytes. Axes are digitized to
+-1, 0 or 1 and mirrored in the direction bits of the bitmask.
+"""
+
+from array import array
+
+AXIS_X = 0
+AXIS_Y = 1
+AXES = 2
+
+BIT_UP = 1 << 0
+BIT_DOWN = 1 << 1
+BIT_LEFT = 1 << 2
+BIT_RIGHT = 1 << 3
+# Negative and positive direction bits of each axis
+AXIS_BITS = ((BIT_LEFT, BIT_RIGHT), (BIT_UP, BIT_DOWN))
+BUTTON_BITS = (1 << 4, 1 << 5, 1 << 6, 1 << 7)
+# Names of the bitmask bits in order, e.g. for remapping keys
+KEY_NAMES = ("up", "down", "left", "right", "1", "2", "3", "4")
+
+# Vote channels of a controller: X, Y and the four buttons
+CHANNELS = AXES + len(BUTTON_BITS)
+BUTTON_CHANNELS = {bit: AXES + button
+                   for button, bit in enumerate(BUTTON_BITS)}
+
+
+class GameState(object):
+    """Controller bitmasks and axes kept in flat arrays.
+
+    Every function in listeners is called as listener(controller,
+    channel, old_value, new_value) for every change made with set_axis
+    or set_button.
+    """
+    __slots__ = ('bitmasks', 'axes', 'listeners')
+
+    def __init__(self, count=0):
+        self.bitmasks = array('B', bytes(count))
+        self.axes = array('b', bytes(AXES * count))
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.bitmasks)
+
+    def resize(self, count):
+        """Change the number of controllers, clearing all of them. The
+        listeners are dropped as whatever they tracked is now stale."""
+        self.bitmasks = array('B', bytes(count))
+        self.axes = array('b', bytes(AXES * count))
+        self.listeners = []
+
+    def set_axis(self, controller, axis, value):
+        """Set an axis to -1, 0 or 1. Returns True if it changed."""
+        index = AXES * controller + axis
+        old_value = self.axes[index]
+        if old_value == value:
+            return False
+        self.axes[index] = value
+        negative, positive = AXIS_BITS[axis]
+        bitmask = self.bitmasks[controller] & ~(negative | positive)
+        if value < 0:
+            bitmask |= negative
+        elif value > 0:
+            bitmask |= positive
+        self.bitmasks[controller] = bitmask
+        for listener in self.listeners:
+            listener(controller, axis, old_value, value)
+        return True
+
+    def set_button(self, controller, bit, pressed):
+        """Set the button with the given bitmask bit. Returns True if it
+        changed."""
+        bitmask = self.bitmasks[controller]
+        if pressed:
+            new_bitmask = bitmask | bit
+        else:
+            new_bitmask = bitmask & ~bit
+        if new_bitmask == bitmask:
+            return False
+        self.bitmasks[controller] = new_bitmask
+        if self.listeners:
+            pressed = 1 if pressed else 0
+            channel = BUTTON_CHANNELS[bit]
+            for listener in self.listeners:
+                listener(controller, channel, 1 - pressed, pressed)
+        return True
+
+    def get_channels(self, controller):
+        """Get the vote channels of a controller as a list."""
+        bitmask = self.bitmasks[controller]
+        index = AXES * controller
+        channels = [self.axes[index], self.axes[index + 1]]
+        channels.extend([1 if bitmask & bit else 0 for bit in BUTTON_BITS])
+        return channels
+
+    def set_channels(self, controller, channels):
+        """Set a controller from vote channels, see get_channels."""
+        for axis in range(AXES):
+            self.set_axis(controller, axis, channels[axis])
+        for button, bit in enumerate(BUTTON_BITS):
+            self.set_button(controller, bit, channels[AXES + button])
+
+    def set_bitmask(self, controller, bitmask):
+        """Set a controller from a UDLRABCD bitmask. Opposite directions
+        cancel each other out. Returns True if it changed."""
+        if self.listeners:
+            changed = False
+            for axis, (negative, positive) in enumerate(AXIS_BITS):
+                value = (1 if bitmask & positive else 0) - \
+                    (1 if bitmask & negative else 0)
+                if self.set_axis(controller, axis, value):
+                    changed = True
+            for bit in BUTTON_BITS:
+                if self.set_button(controller, bit, bitmask & bit):
+                    changed = True
+            return changed
+
+        index = AXES * controller
+        for axis, (negative, positive) in enumerate(AXIS_BITS):
+            value = (1 if bitmask & positive else 0) - \
+                (1 if bitmask & negative else 0)
+            if not value:
+                bitmask &= ~(negative | positive)
+            self.axes[index + axis] = value
+        if self.bitmasks[controller] == bitmask:
+            return False
+        self.bitmasks[controller] = bitmask
+        return True
+
+    def copy_controller(self, controller, other, other_controller):
+        """Copy a controller of another game state into this one."""
+        if self.listeners:
+            self.set_bitmask(controller, other.bitmasks[other_controller])
+            return
+        self.bitmasks[controller] = other.bitmasks[other_controller]
+        index = AXES * controller
+        other_index = AXES * other_controller
+        self.axes[index:index + AXES] = \
+            other.axes[other_index:other_index + AXES]
@@ -51,6 +51,7 @@ from __future__ import division
 import os
 import sys
 import io
+import asyncio
 import glob
 import select
 import struct
@@ -104,6 +105,9 @@ def iter_unpack(raw):
 EVENT_FORMAT = str('llHHi')
 EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
 
+# Number of events a batched read can drain from the kernel at once.
+BATCH_READ_SIZE = 64
+
 SPECIAL_DEVICES = (
     ("Raspberry Pi Sense HAT Joystick",
      "/dev/input/by-id/gpio-Raspberry_Pi_Sense_HAT_Joystick-event-kbd"),)
@@ -1258,6 +1262,41 @@ EVENT_MAP = (
     ('Current', CURRENT))
 
 
+def pack_event_code(raw_type, raw_code):
+    """Pack a raw event type and code into one integer key."""
+    return (raw_type << 16) | raw_code
+
+
+def _build_event_tables():
+    """Flatten EVENT_MAP into lookups keyed by packed type and code.
+
+    Returns (names, numbers): names maps packed codes to code names and
+    numbers maps code names back to packed codes.
+    """
+    codes = {key: dict(value) for key, value in EVENT_MAP}
+    names = {}
+    for raw_type, evtype in codes['types'].items():
+        for raw_code, name in codes.get(evtype, {}).items():
+            names[pack_event_code(raw_type, raw_code)] = name
+    numbers = {}
+    for number, name in names.items():
+        numbers.setdefault(name, number)
+    if WIN:
+        # Windows key codes are mapped to the common ones when possible
+        key_type = codes['type_codes']['Key']
+        for wincode, code in codes['wincodes'].items():
+            try:
+                name = codes['Key'][code]
+            except KeyError:
+                continue
+            names[pack_event_code(key_type, wincode)] = name
+    return names, numbers
+
+
+# Built once at import, so forked processes share the tables.
+EVENT_NAMES, EVENT_CODES = _build_event_tables()
+
+
 # Now comes all the structs we need to parse the infomation coming
 # from Windows.
 
@@ -1369,16 +1408,41 @@ class UnknownEventCode(IndexError):
 
 
 class InputEvent(object):
-    """A user event."""
+    """A user event.
+
+    Built straight from the unpacked evdev struct; the type and code
+    names are only looked up when they are accessed. Consumers that
+    only care about numbers can compare pack_event_code(raw_type,
+    raw_code) against EVENT_CODES and never touch a string.
+    """
     # pylint: disable=too-few-public-methods
-    def __init__(self,
-                 device,
-                 event_info):
+    __slots__ = ('device', 'tv_sec', 'tv_usec', 'raw_type', 'raw_code',
+                 'state')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, device, tv_sec, tv_usec, raw_type, raw_code, state):
         self.device = device
-        self.timestamp = event_info["timestamp"]
-        self.code = event_info["code"]
-        self.state = event_info["state"]
-        self.ev_type = event_info["ev_type"]
+        self.tv_sec = tv_sec
+        self.tv_usec = tv_usec
+        self.raw_type = raw_type
+        self.raw_code = raw_code
+        self.state = state
+
+    @property
+    def timestamp(self):
+        """Time of the event in seconds."""
+        return self.tv_sec + (self.tv_usec / 1000000)
+
+    @property
+    def ev_type(self):
+        """Name of the event type, e.g. 'Key'."""
+        return self.device.manager.get_event_type(self.raw_type)
+
+    @property
+    def code(self):
+        """Name of the event code, e.g. 'BTN_TOP'."""
+        return self.device.manager.get_event_name(self.raw_type,
+                                                  self.raw_code)
 
 
 class BaseListener(object):
@@ -2004,8 +2068,17 @@ class InputDevice(object):
     # pylint: disable=too-many-instance-attributes
     def __init__(self, manager, device_path,
                  char_path_override=None,
-                 read_size=1):
+                 read_size=1,
+                 batched=False):
         self.read_size = read_size
+        self.batched = batched
+        if batched:
+            # Reusable buffer that a batched read drains the kernel into
+            self._read_buffer = bytearray(EVENT_SIZE * max(read_size, 1))
+            self._read_view = memoryview(self._read_buffer)
+        # Events a buffered file read ahead before switching to batched
+        # reads, see _use_batched_reads
+        self._read_ahead = b""
         self.manager = manager
         self._device_path = device_path
         self.protocol, _, self.device_type = self._get_path_infomation()
@@ -2050,8 +2123,13 @@ class InputDevice(object):
                 self._character_file = io.BytesIO()
                 return self._character_file
             try:
-                self._character_file = io.open(
-                    self._character_device_path, 'rb')
+                if self.batched:
+                    self._character_file = io.open(
+                        self._character_device_path, 'rb', buffering=0)
+                    os.set_blocking(self._character_file.fileno(), False)
+                else:
+                    self._character_file = io.open(
+                        self._character_device_path, 'rb')
             except IOError as err:
                 if err.errno == 13:
                     raise PermissionDenied(
@@ -2073,6 +2151,22 @@ class InputDevice(object):
         """Get data from the character device."""
         return self._character_device.read(read_size)
 
+    def _get_batched_data(self):
+        """Drain everything the kernel has buffered for the device with
+        a single non-blocking read into the reusable read buffer."""
+        if self._read_ahead:
+            data, self._read_ahead = self._read_ahead, b""
+            return data
+        character_device = self._character_device
+        nbytes = character_device.readinto(self._read_buffer)
+        if nbytes is None:
+            # Nothing buffered yet, wait for the device to be readable
+            select.select([character_device], [], [])
+            nbytes = character_device.readinto(self._read_buffer)
+        if not nbytes:
+            return None
+        return self._read_view[:nbytes]
+
     @staticmethod
     def _get_target_function():
         """Get the correct target function. This is only used by Windows
@@ -2080,33 +2174,71 @@ class InputDevice(object):
         return False
 
     def _do_iter(self):
-        if self.read_size:
-            read_size = EVENT_SIZE * self.read_size
+        if self.batched:
+            data = self._get_batched_data()
         else:
-            read_size = EVENT_SIZE
-        data = self._get_data(read_size)
+            if self.read_size:
+                read_size = EVENT_SIZE * self.read_size
+            else:
+                read_size = EVENT_SIZE
+            data = self._get_data(read_size)
         if not data:
             return
         evdev_objects = iter_unpack(data)
-        events = [self._make_event(*event) for event in evdev_objects]
+        events = [InputEvent(self, *event) for event in evdev_objects]
         return events
 
-    # pylint: disable=too-many-arguments
-    def _make_event(self, tv_sec, tv_usec, ev_type, code, value):
-        event_type = self.manager.get_event_type(ev_type)
-        eventinfo = {
-            "ev_type": event_type,
-            "state": value,
-            "timestamp": tv_sec + (tv_usec / 1000000),
-            "code": self.manager.get_event_string(event_type, code)
-        }
-
-        return InputEvent(self, eventinfo)
-
     def read(self):
         """Read the next input event."""
         return next(iter(self))
 
+    def fileno(self):
+        """Get the file descriptor of the character device, e.g. for
+        waiting on several devices with select or epoll."""
+        return self._character_device.fileno()
+
+    def _use_batched_reads(self):
+        """Switch an unbatched device to the unbuffered, non-blocking
+        reads of a batched one. Events that the buffered file has
+        already read ahead are returned by the next read."""
+        if not NIX:
+            raise TypeError("Non-blocking reads are only supported on Linux")
+        self._read_buffer = bytearray(EVENT_SIZE * BATCH_READ_SIZE)
+        self._read_view = memoryview(self._read_buffer)
+        self.batched = True
+        if self._character_file is not None:
+            os.set_blocking(self._character_file.fileno(), False)
+            self._read_ahead = self._character_file.read(
+                len(self._character_file.peek(0)))
+            self._character_file = self._character_file.detach()
+
+    def read_pending(self):
+        """Read all events the device has buffered without blocking.
+
+        Returns an empty list if nothing is pending. Unbatched devices
+        are switched to batched reads on the first call.
+        """
+        if not self.batched:
+            self._use_batched_reads()
+        if self._read_ahead:
+            data, self._read_ahead = self._read_ahead, b""
+            return [InputEvent(self, *event) for event in iter_unpack(data)]
+        nbytes = self._character_device.readinto(self._read_buffer)
+        if nbytes is None:
+            return []
+        if not nbytes:
+            raise UnpluggedError("%s was unplugged" % self.name)
+        return [InputEvent(self, *event)
+                for event in iter_unpack(self._read_view[:nbytes])]
+
+    def events(self):
+        """Asynchronously iterate over the events of the device.
+
+        >>> async for event in gamepad.events():
+        ...     print(event.code, event.state)
+        """
+        return read_many([self])
+
     @property
     def _pipe(self):
         """On Windows we use a pipe to emulate a Linux style character
@@ -2178,12 +2310,19 @@ class Mouse(InputDevice):
 
 
 class GamePad(InputDevice):
-    """A gamepad or other joystick-like device."""
+    """A gamepad or other joystick-like device.
+
+    On Linux reads are batched by default, see DeviceManager.
+    """
     def __init__(self, manager, device_path,
                  char_path_override=None):
-        super(GamePad, self).__init__(manager,
-                                      device_path,
-                                      char_path_override)
+        batched = NIX and manager.gamepad_batch_size > 0
+        super(GamePad, self).__init__(
+            manager,
+            device_path,
+            char_path_override,
+            read_size=manager.gamepad_batch_size if batched else 1,
+            batched=batched)
         if WIN:
             if "Microsoft_Corporation_Controller" in self._device_path:
                 self.name = "Microsoft X-Box 360 pad"
@@ -2459,11 +2598,18 @@ class RawInputDeviceList(ctypes.Structure):
 
 class DeviceManager(object):
     """Provides access to all connected and detectible user input
-    devices."""
+    devices.
+
+    gamepad_batch_size is the maximum number of events a gamepad read
+    drains from the kernel at once. Set it to 0 to read one event per
+    read call instead.
+    """
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self):
+    def __init__(self, gamepad_batch_size=BATCH_READ_SIZE):
+        self.gamepad_batch_size = gamepad_batch_size
         self.codes = {key: dict(value) for key, value in EVENT_MAP}
+        self.event_names = EVENT_NAMES
         self.keyboards = []
         self.mice = []
         self.gamepads = []
@@ -2689,6 +2835,15 @@ class DeviceManager(object):
         except KeyError:
             raise UnknownEventCode("We don't know this event.")
 
+    def get_event_name(self, raw_type, raw_code):
+        """Get the string name of a raw event with a single lookup."""
+        try:
+            return self.event_names[pack_event_code(raw_type, raw_code)]
+        except KeyError:
+            # Raise the right error for the unknown type or code
+            return self.get_event_string(self.get_event_type(raw_type),
+                                         raw_code)
+
 
 devices = DeviceManager()  # pylint: disable=invalid-name
 
@@ -2711,6 +2866,38 @@ def get_mouse():
     return mouse.read()
 
 
+async def read_many(input_devices):
+    """Asynchronously iterate over the events of several input devices.
+
+    The devices are watched with loop.add_reader, so they have to be
+    character devices on Linux. The events of each device come in the
+    same order as from read().
+    """
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    # Start by draining whatever is already buffered
+    ready = set(input_devices)
+    readable.set()
+
+    def on_readable(device):
+        ready.add(device)
+        readable.set()
+
+    for device in input_devices:
+        loop.add_reader(device.fileno(), on_readable, device)
+    try:
+        while True:
+            await readable.wait()
+            readable.clear()
+            while ready:
+                device = ready.pop()
+                for event in device.read_pending():
+                    yield event
+    finally:
+        for device in input_devices:
+            loop.remove_reader(device.fileno())
+
+
 def get_gamepad(*, timeout=None):
     """Get a single action from a gamepad."""
     try:
@@ -0,0 +1,74 @@
+"""Latency histograms of the stages of the send loop.
+
+Latencies are counted in nanoseconds in buckets of logarithmic width, as
+in HdrHistogram: every power of two is split into SUB_BUCKETS buckets,
+so any percentile is within 1% of the true value however long the run
+and recording a value takes constant time and no allocation once the
+range has been seen.
+"""
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+PERCENTILES = (50, 99, 99.9)
+
+
+class Histogram(object):
+    """Counts of latencies in nanoseconds."""
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        """Count one latency. Negative ones, e.g. from clocks out of
+        sync, are counted as 0."""
+        if value < 0:
+            value = 0
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+        index = shift * SUB_BUCKETS + (value >> shift)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Latency that percent of the counted ones are at or below."""
+        wanted = self.count * percent / 100
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if count and total >= wanted:
+                shift = max(0, index // SUB_BUCKETS - 1)
+                lowest = (index - shift * SUB_BUCKETS) << shift
+                # Middle of the bucket
+                return lowest + ((1 << shift) >> 1)
+        return 0
+
+
+class LatencyStats(object):
+    """Histograms of named stages, in the order they are first used."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, stage, value):
+        """Count a latency of stage in nanoseconds."""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(value)
+
+    def report(self):
+        """Percentiles of every stage as text, one line per stage."""
+        lines = []
+        for stage, histogram in self.histograms.items():
+            percentiles = ", ".join(
+                "p{:g} {:.1f} us".format(
+                    percent, histogram.percentile(percent) / 1000)
+                for percent in PERCENTILES)
+            lines.append("{}: {} samples, {}, max {:.1f} us".format(
+                stage, histogram.count, percentiles, histogram.max / 1000))
+        return "\n".join(lines)
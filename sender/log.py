@@ -0,0 +1,54 @@
+"""Logging of the sender.
+
+Messages go through the standard logging module. Per-packet messages
+are logged at DEBUG level, so with the default INFO level they cost a
+level check and nothing is written. Every message is also rate limited
+by its format string, so even a debug run can't stall the send loop
+writing to a slow terminal.
+"""
+
+import logging
+import time
+
+LEVELS = ("debug", "info", "warning", "error")
+# Records let through per second for each message format
+RATE = 10
+FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+logger = logging.getLogger("gamepad-mux")
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most rate records per second of every message
+    format. The number of records dropped is added to the next record
+    that is let through."""
+
+    def __init__(self, rate=RATE):
+        super().__init__()
+        self.rate = rate
+        # Start of the current second, records let through and records
+        # dropped for every message format
+        self.__counts = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        start, passed, dropped = self.__counts.get(record.msg, (now, 0, 0))
+        if now - start >= 1:
+            start, passed = now, 0
+        if passed >= self.rate:
+            self.__counts[record.msg] = (start, passed, dropped + 1)
+            return False
+        self.__counts[record.msg] = (start, passed + 1, 0)
+        if dropped:
+            record.msg = "{} ({} similar messages dropped)".format(
+                record.msg, dropped)
+        return True
+
+
+def setup(level="info", rate=RATE):
+    """Log messages of level and above to stderr."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.addFilter(RateLimitFilter(rate))
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
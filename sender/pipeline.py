@@ -0,0 +1,67 @@
+"""Chains of game state mappers.
+
+A mapper takes a GameState and returns a GameState. Every mapper keeps
+its output in a game state it allocated once and updates in place, so
+the output of one stage is fed straight to the next one without
+copying. Stages can be listed in a JSON file:
+
+    {"stages": [
+        {"democracy": 4, "vote-engine": "incremental"},
+        {"time-mux": 2},
+        {"remap": "1=2,2=1"}
+    ]}
+
+Every stage is an object of the command line options of one mode,
+without the leading dashes.
+"""
+
+import json
+import time
+
+from latency import LatencyStats
+
+
+class Pipeline(object):
+    """Runs the mappers of stages, a list of (name, mapper) pairs, one
+    after another and keeps a histogram of the time spent in each one."""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.stats = LatencyStats()
+        self.__names = ["{}. {}".format(stage, name)
+                        for stage, (name, _) in enumerate(self.stages)]
+        self.__deadlines = [getattr(mapper, "deadline", None)
+                            for _, mapper in self.stages]
+
+    def __call__(self, game_state):
+        for stage, (_, mapper) in enumerate(self.stages):
+            start_ns = time.perf_counter_ns()
+            game_state = mapper(game_state)
+            self.stats.record(self.__names[stage],
+                              time.perf_counter_ns() - start_ns)
+        return game_state
+
+    def deadline(self):
+        """Earliest monotonic time when the output of any stage may
+        change, or None."""
+        deadlines = [deadline() for deadline in self.__deadlines
+                     if deadline is not None]
+        deadlines = [deadline for deadline in deadlines
+                     if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def report(self):
+        """Timing of every stage as text, one line per stage."""
+        return self.stats.report()
+
+
+def load_stages(path):
+    """Read the list of stage options from a JSON file."""
+    with open(path) as config_file:
+        config = json.load(config_file)
+    stages = config.get("stages") if isinstance(config, dict) else None
+    if not isinstance(stages, list) or \
+            not all(isinstance(stage, dict) for stage in stages):
+        raise ValueError("{}: expected an object with a list of objects "
+                         "in \"stages\"".format(path))
+    return stages
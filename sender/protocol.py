@@ -0,0 +1,98 @@
+"""Wire format of the packets sent to the receivers.
+
+A packet is a fixed header followed by one bitmask byte per controller.
+Bit i of a bitmask is the i:th key of UDLRABCD, i.e. bit 0 is up and
+bit 7 is button D.
+
+    magic     2 bytes  b"GM"
+    version   1 byte
+    session   1 byte   random for every run of the sender, tells a
+                       restarted sender apart from late packets
+    sequence  4 bytes  starts from a random value and increases by one
+                       for every packet
+    timestamp 8 bytes  wall clock time of the input the state is based
+                       on in nanoseconds, or of the first packet of
+                       the state if it had no input
+    count     2 bytes  number of controllers
+
+All fields are in network byte order. The legacy format is the ASCII
+string of "0"/"1" characters, eight per controller, without a header.
+
+receiver/receive.py runs on its own machine and decodes the packets
+with its own copy of these constants, which must be kept the same.
+"""
+
+import random
+import struct
+import time
+
+MAGIC = b"GM"
+VERSION = 1
+HEADER_FORMAT = "!2sBBIQH"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+KEYS_PER_CONTROLLER = 8
+
+_header = struct.Struct(HEADER_FORMAT)
+
+
+class PacketEncoder(object):
+    """Encodes controller bitmasks into binary packets.
+
+    The packet is built in a preallocated buffer that only grows when
+    the number of controllers does.
+    """
+
+    def __init__(self):
+        # Receivers start counting over when the session changes
+        self.session = random.getrandbits(8)
+        self.sequence = random.getrandbits(32)
+        self.timestamp = 0
+        self.__buffer = bytearray(HEADER_SIZE)
+
+    def encode(self, bitmasks, timestamp=None):
+        """Encode a sequence of bitmasks, one per controller. timestamp
+        is the time.time_ns() of the input they are based on, now by
+        default."""
+        count = len(bitmasks)
+        size = HEADER_SIZE + count
+        if len(self.__buffer) != size:
+            self.__buffer = bytearray(size)
+        self.__buffer[HEADER_SIZE:] = bytes(bitmasks)
+        self.timestamp = time.time_ns() if timestamp is None else timestamp
+        return self.repeat()
+
+    def repeat(self):
+        """Encode the previous bitmasks again. Only the header is
+        rebuilt, as every packet needs a new sequence number. The
+        timestamp stays that of the input, so a receiver that only gets
+        the repeat still measures the latency from the input."""
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        _header.pack_into(self.__buffer, 0, MAGIC, VERSION, self.session,
+                          self.sequence, self.timestamp,
+                          len(self.__buffer) - HEADER_SIZE)
+        return bytes(self.__buffer)
+
+
+class LegacyEncoder(object):
+    """Encodes controller bitmasks as the old "UDLRABCD" ASCII string."""
+
+    # Precomputed text of every possible bitmask
+    __texts = [
+        "".join("1" if bitmask & (1 << bit) else "0"
+                for bit in range(KEYS_PER_CONTROLLER)).encode("ascii")
+        for bitmask in range(1 << KEYS_PER_CONTROLLER)]
+
+    def __init__(self):
+        self.__payload = b""
+
+    def encode(self, bitmasks, timestamp=None):
+        """Encode a sequence of bitmasks, one per controller. The legacy
+        format has no timestamp."""
+        self.__payload = b"".join([self.__texts[bitmask]
+                                   for bitmask in bitmasks])
+        return self.__payload
+
+    def repeat(self):
+        """Encode the previous bitmasks again."""
+        return self.__payload
+
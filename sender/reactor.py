@@ -0,0 +1,59 @@
+"""Single-threaded event loop for reading any number of gamepads.
+
+All character devices are registered with one epoll object, and events
+are handed to the caller's handler as soon as a device is readable. A
+gamepad only has to provide fileno() and a non-blocking read_pending(),
+so pipes or FIFOs can stand in for /dev/input/event* devices.
+"""
+
+import select
+
+
+class GamepadReactor(object):
+    """Dispatches events from several gamepads to a handler.
+
+    handler is called as handler(gamepad_id, events) and should return
+    True if the events changed the game state. Removed gamepads raise
+    OSError or UnpluggedError from poll().
+
+    reads and events count the reads of readable gamepads and the events
+    they returned, and max_depth is the most events queued on one
+    gamepad at once.
+    """
+
+    def __init__(self, gamepads, handler):
+        self.__handler = handler
+        self.__gamepads = {}
+        self.__epoll = select.epoll()
+        self.reads = 0
+        self.events = 0
+        self.max_depth = 0
+        for gamepad_id, gamepad in gamepads:
+            fd = gamepad.fileno()
+            self.__gamepads[fd] = (gamepad_id, gamepad)
+            self.__epoll.register(fd, select.EPOLLIN)
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds for input and dispatch every
+        pending event. Returns True if the game state changed."""
+        changed = False
+        for fd, _ in self.__epoll.poll(-1 if timeout is None else timeout):
+            gamepad_id, gamepad = self.__gamepads[fd]
+            events = gamepad.read_pending()
+            self.reads += 1
+            self.events += len(events)
+            if len(events) > self.max_depth:
+                self.max_depth = len(events)
+            if events and self.__handler(gamepad_id, events):
+                changed = True
+        return changed
+
+    def report(self):
+        """Queue depth statistics as text."""
+        mean_depth = self.events / self.reads if self.reads else 0
+        return "Read {} events in {} reads, {:.1f} per read, at most {}" \
+            .format(self.events, self.reads, mean_depth, self.max_depth)
+
+    def close(self):
+        """Stop watching the gamepads."""
+        self.__epoll.close()
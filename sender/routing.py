@@ -0,0 +1,66 @@
+"""Routing of virtual controllers to destinations.
+
+Every destination gets only the controllers routed to it, in the order
+they were listed, or all of them. Destinations with the same controllers
+share one slice, which is encoded once per change and only sent when
+its own controllers have changed.
+"""
+
+from collections import OrderedDict
+
+
+class Slice(object):
+    """Controllers sent to a group of destinations and their encoder."""
+
+    def __init__(self, controllers, encoder):
+        self.controllers = controllers
+        self.destinations = []
+        self.encoder = encoder
+        self.bitmasks = None
+
+    def select(self, bitmasks):
+        """Pick the controllers of this slice out of all bitmasks.
+        Controllers that don't exist are sent released."""
+        if self.controllers is None:
+            return bitmasks
+        count = len(bitmasks)
+        return bytes([bitmasks[controller] if controller < count else 0
+                      for controller in self.controllers])
+
+
+class Router(object):
+    """Sends the slices of the output bitmasks to their destinations.
+
+    routes is a list of (destination, controllers) pairs, where
+    controllers is a list of virtual controller numbers or None for all
+    of them. send is called as send(destinations, payload).
+    """
+
+    def __init__(self, routes, encoder_class, send):
+        self.__send = send
+        slices = OrderedDict()
+        for destination, controllers in routes:
+            key = None if controllers is None else tuple(controllers)
+            if key not in slices:
+                slices[key] = Slice(key, encoder_class())
+            slices[key].destinations.append(destination)
+        self.slices = list(slices.values())
+
+    def update(self, bitmasks, timestamp=None):
+        """Send the slices whose controllers have changed. timestamp is
+        the time of the input they are based on, see
+        PacketEncoder.encode."""
+        for route_slice in self.slices:
+            bitmasks_slice = route_slice.select(bitmasks)
+            if bitmasks_slice != route_slice.bitmasks:
+                route_slice.bitmasks = bitmasks_slice
+                self.__send(route_slice.destinations,
+                            route_slice.encoder.encode(bitmasks_slice,
+                                                       timestamp))
+
+    def repeat(self):
+        """Resend every slice as a heartbeat."""
+        for route_slice in self.slices:
+            if route_slice.bitmasks is not None:
+                self.__send(route_slice.destinations,
+                            route_slice.encoder.repeat())
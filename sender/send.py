@@ -1,238 +1,923 @@
 #!/usr/bin/env python3
 
-from inputs import devices, get_gamepad
+from inputs import devices, UnpluggedError, EVENT_CODES, pack_event_code
+from reactor import GamepadReactor
+from protocol import PacketEncoder, LegacyEncoder
+from gamestate import GameState, CHANNELS, AXIS_X, AXIS_Y, BUTTON_BITS, \
+    KEY_NAMES
+from pipeline import Pipeline, load_stages
+from routing import Router
+from fanout import FanOut
+from latency import LatencyStats
+from log import logger
+import log
+import vote
+from collections import OrderedDict
+import argparse
+import random
+import signal
 import socket
 import time
-import queue
 import sys
-import threading
+
+# Seconds between resending an unchanged state, doubling while idle
+HEARTBEAT_MIN = 0.05
+HEARTBEAT_MAX = 1.0
+# Seconds without packets after which receive.py releases all keys by
+# default. The longest heartbeat interval must stay below it.
+RECEIVER_LINK_TIMEOUT = 3.0
+
+# Multicast packets stay in the local network by default
+MULTICAST_TTL = 1
+
+# Events are matched by packed type and code, not by name
+AXIS_CODES = {
+    EVENT_CODES["ABS_X"]: AXIS_X,
+    EVENT_CODES["ABS_Y"]: AXIS_Y,
+}
+BUTTON_CODES = {
+    EVENT_CODES["BTN_TOP"]: BUTTON_BITS[0],
+    EVENT_CODES["BTN_THUMB2"]: BUTTON_BITS[1],
+    EVENT_CODES["BTN_THUMB"]: BUTTON_BITS[2],
+    EVENT_CODES["BTN_BASE3"]: BUTTON_BITS[3],
+}
 
 
 def all_controllers_are_separate(separate_game_state):
     return separate_game_state
 
 
-def one_democratic_controller(number_of_virtual_controllers):
+def one_democratic_controller(number_of_virtual_controllers,
+                              grouping=vote.balanced_groups):
+    democratic_game_state = GameState(number_of_virtual_controllers)
+    # Group of every real controller, built when their number changes
+    groups = []
 
     def mapper(full_game_state):
+        nonlocal groups
+        if len(groups) != len(full_game_state):
+            groups = grouping(len(full_game_state),
+                              number_of_virtual_controllers)
 
-        democratic_game_state = []
-        for i in range(number_of_virtual_controllers):
-            democratic_game_state.append({
-                "X": 0,
-                "Y": 0,
-                "1": 0,
-                "2": 0,
-                "3": 0,
-                "4": 0,
-            })
-        number_of_real_controllers = len(full_game_state)
-
-        # print("FULL", full_game_state)
-        # print("DEMO", democratic_game_state)
-        controller_ratio = number_of_real_controllers // number_of_virtual_controllers
         # Sum inputs
-        for controller_number, controller in enumerate(full_game_state): 
-            demoratic_controller_index = controller_number // controller_ratio
-            if demoratic_controller_index >= number_of_virtual_controllers:
+        sums = [[0] * CHANNELS for i in range(number_of_virtual_controllers)]
+        for controller_number, group in enumerate(groups):
+            if group < 0:
                 continue
-            # print(controller_number, demoratic_controller_index, controller)
-            for channel, value in controller.items():
-                # print(channel, value)
-                democratic_game_state[demoratic_controller_index][channel] += value
-        # print("game state sum:", democratic_game_state)
+            channel_sums = sums[group]
+            channels = full_game_state.get_channels(controller_number)
+            for channel, value in enumerate(channels):
+                channel_sums[channel] += value
 
         # Filter inputs with only one supporter
-        for controller in democratic_game_state:
-            for channel, value in controller.items():
+        for controller, channel_sums in enumerate(sums):
+            for channel, value in enumerate(channel_sums):
                 if value < -1:
-                    controller[channel] = -1
+                    channel_sums[channel] = -1
                 elif value > 1:
-                    controller[channel] = 1
+                    channel_sums[channel] = 1
                 else:
-                    controller[channel] = 0
+                    channel_sums[channel] = 0
+            democratic_game_state.set_channels(controller, channel_sums)
 
         return democratic_game_state
 
     return mapper
 
 
-def time_mux_controller(rate):
+def time_mux_controller(rate, weights=None, randomize=False):
+    """Pass through one controller at a time, switching RATE times per
+    second.
+
+    Slots are counted on the monotonic clock from a fixed start, so
+    they don't drift or jump with the wall clock, and the mapper's
+    deadline() wakes the send loop at every slot boundary. With weights
+    controller i keeps its turn for weights[i] slots. With randomize a
+    random controller is picked for every slot, in proportion to the
+    weights.
+    """
+    muxed_game_state = GameState(1)
+    slot_ns = int(1000000000 / rate)
+    start_ns = time.monotonic_ns()
+    # Controller of every slot in one cycle, built for the number of
+    # controllers it was built for
+    schedule = []
+    scheduled_controllers = None
+    current_slot = -1
+    current_controller = 0
+    generator = random.Random()
+
     def mapper(game_state):
-        controller_index = int(time.time() * rate) % len(game_state)
-        return [game_state[controller_index]]
+        nonlocal schedule, scheduled_controllers, current_slot
+        nonlocal current_controller
+        if scheduled_controllers != len(game_state):
+            scheduled_controllers = len(game_state)
+            schedule = []
+            for controller in range(scheduled_controllers):
+                weight = 1
+                if weights and controller < len(weights):
+                    weight = weights[controller]
+                schedule.extend([controller] * weight)
+
+        slot = (time.monotonic_ns() - start_ns) // slot_ns
+        if slot != current_slot:
+            current_slot = slot
+            if not schedule:
+                current_controller = None
+            elif randomize:
+                current_controller = generator.choice(schedule)
+            else:
+                current_controller = schedule[slot % len(schedule)]
+
+        if current_controller is not None:
+            muxed_game_state.copy_controller(0, game_state,
+                                             current_controller)
+        return muxed_game_state
+
+    def deadline():
+        return (start_ns + (current_slot + 1) * slot_ns) / 1000000000
+
+    mapper.deadline = deadline
     return mapper
 
 
-def usage():
-    print("Usage: {} [--democracy|--time-mux RATE] REMOTE_HOST...".format(sys.argv[0]))
-    print("   REMOTE_HOST         One or more addresses to send inputs to")
-    print("   --democracy NUMBER  Map NUMBER controllers into one. At least two inputs are required to activate.")
-    print("   --time-mux RATE     Multiplex all controllers into one, changing it RATE times per second")
-    sys.exit(0)
+def random_controller(interval=None, seed=None, no_repeat=False,
+                      active_window=None):
+    """Pass through one randomly chosen controller.
+
+    A new controller is chosen every interval seconds, or after every
+    input event if interval is None. With a seed the choices can be
+    reproduced. no_repeat never chooses the same controller twice in a
+    row. With active_window only controllers that have had input in
+    the last active_window seconds are chosen, if there are any.
+    """
+    chosen_game_state = GameState(1)
+    generator = random.Random(seed)
+    slot_ns = int(1000000000 * interval) if interval else None
+    start_ns = time.monotonic_ns()
+    current_slot = -1
+    current_controller = None
+    source = None
+    switch = True
+    # Controllers by their last input, most recent last
+    activity = OrderedDict()
+
+    def on_change(controller, channel, old_value, new_value):
+        nonlocal switch
+        if active_window is not None:
+            activity[controller] = time.monotonic()
+            activity.move_to_end(controller)
+        if slot_ns is None:
+            switch = True
+
+    def candidates(count):
+        if active_window is None:
+            return None
+        oldest = time.monotonic() - active_window
+        while activity and next(iter(activity.values())) < oldest:
+            activity.popitem(last=False)
+        active = [controller for controller in activity
+                  if controller < count]
+        return active or None
+
+    def choose(count):
+        active = candidates(count)
+        population = len(active) if active is not None else count
+        if no_repeat and population > 1 and current_controller is not None:
+            if active is None:
+                # Skip over the current controller
+                choice = generator.randrange(count - 1)
+                if choice >= current_controller:
+                    choice += 1
+                return choice
+            active = [controller for controller in active
+                      if controller != current_controller] or active
+            population = len(active)
+        choice = generator.randrange(population)
+        return active[choice] if active is not None else choice
 
-game_state_mapper = all_controllers_are_separate
+    def mapper(game_state):
+        nonlocal source, current_slot, current_controller, switch
+        if game_state is not source or \
+                on_change not in game_state.listeners:
+            source = game_state
+            activity.clear()
+            game_state.listeners.append(on_change)
+            switch = True
+
+        if slot_ns is not None:
+            slot = (time.monotonic_ns() - start_ns) // slot_ns
+            if slot != current_slot:
+                current_slot = slot
+                switch = True
+
+        if switch or (current_controller is not None and
+                      current_controller >= len(game_state)):
+            switch = False
+            current_controller = choose(len(game_state)) \
+                if len(game_state) else None
+
+        if current_controller is not None:
+            chosen_game_state.copy_controller(0, game_state,
+                                              current_controller)
+        return chosen_game_state
+
+    if slot_ns is not None:
+        def deadline():
+            return (start_ns + (current_slot + 1) * slot_ns) / 1000000000
+
+        mapper.deadline = deadline
+    return mapper
 
-args = sys.argv[1:]
-if len(args) == 0:
-    usage()
 
-if args[0] == "--democracy":
-    print("Using democracy mode")
-    try:
-        rate = int(args[1])
-    except ValueError:
-        print("NUMBER is not a number, got", rate)
-        usage()
-    game_state_mapper = one_democratic_controller(rate)
-    args = args[2:]
-
-elif len(args) >= 2 and args[0] == "--time-mux":
-    print("Using time-basec multiplexing")
+def select_controllers(indices):
+    """Pass through the controllers with the given indices, in order.
+    Controllers that aren't connected are left released."""
+    selected_game_state = GameState(len(indices))
+
+    def mapper(game_state):
+        for controller, index in enumerate(indices):
+            if index < len(game_state):
+                selected_game_state.copy_controller(controller, game_state,
+                                                    index)
+            else:
+                selected_game_state.set_bitmask(controller, 0)
+        return selected_game_state
+
+    return mapper
+
+
+def remap_keys(mapping):
+    """Move keys to other keys. mapping maps a bitmask bit to the bits
+    it is replaced with, 0 to drop the key. Other keys stay as they
+    are."""
+    # Remapped bitmask of every possible bitmask
+    table = []
+    for bitmask in range(1 << len(KEY_NAMES)):
+        remapped = 0
+        for key in range(len(KEY_NAMES)):
+            bit = 1 << key
+            if bitmask & bit:
+                remapped |= mapping.get(bit, bit)
+        table.append(remapped)
+    remapped_game_state = GameState()
+
+    def mapper(game_state):
+        if len(remapped_game_state) != len(game_state):
+            remapped_game_state.resize(len(game_state))
+        for controller, bitmask in enumerate(game_state.bitmasks):
+            remapped_game_state.set_bitmask(controller, table[bitmask])
+        return remapped_game_state
+
+    return mapper
+
+
+def add_mapper_arguments(parser):
+    """Add the options of the mapper modes to parser. Returns the group
+    of mutually exclusive modes."""
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--democracy", type=int, metavar="NUMBER",
+        help="Map NUMBER controllers into one. At least two inputs are "
+             "required to activate.")
+    parser.add_argument(
+        "--vote-engine", choices=("loop", "numpy", "incremental",
+                                  "weighted"),
+        help="How democracy mode counts the votes. numpy is faster with "
+             "hundreds of voters, incremental keeps running tallies and "
+             "does not depend on the number of voters at all and "
+             "weighted adds the --vote-* options below. (default: loop, "
+             "or weighted if any --vote-* option is given)")
+    parser.add_argument(
+        "--vote-groups", type=parse_grouping,
+        metavar="balanced|round-robin|G1,G2,...",
+        help="How real controllers are split between the virtual ones: "
+             "consecutive groups of equal size, dealt in turn, or the "
+             "virtual controller of each real one in order, -1 for none "
+             "(default: balanced)")
+    parser.add_argument(
+        "--vote-weights", type=parse_weights, metavar="W1,W2,...",
+        help="Vote weight of each real controller in order, 1 for the rest")
+    parser.add_argument(
+        "--vote-min", type=float, metavar="WEIGHT",
+        help="Vote weight needed to activate an input (default: 2)")
+    parser.add_argument(
+        "--vote-quorum", type=float, metavar="PERCENT",
+        help="Percentage of the weight of active voters needed to "
+             "activate an input, on top of --vote-min")
+    parser.add_argument(
+        "--vote-window", type=float, metavar="MS",
+        help="Milliseconds a vote keeps counting after it is released")
+    mode.add_argument(
+        "--time-mux", type=float, metavar="RATE",
+        help="Multiplex all controllers into one, changing it RATE times "
+             "per second")
+    mode.add_argument(
+        "--random", type=float, metavar="SECONDS",
+        help="Pass through a random controller, choosing a new one every "
+             "SECONDS, or after every input if SECONDS is 0")
+    parser.add_argument(
+        "--random-seed", type=int, metavar="SEED",
+        help="Seed for reproducible random choices")
+    parser.add_argument(
+        "--random-no-repeat", action="store_true",
+        help="Never choose the same controller twice in a row")
+    parser.add_argument(
+        "--random-active", type=float, metavar="MS",
+        help="Only choose controllers that have had input in the last MS "
+             "milliseconds, if there are any")
+    parser.add_argument(
+        "--time-mux-weights", type=parse_slot_weights, metavar="W1,W2,...",
+        help="Number of slots each controller keeps its turn for in "
+             "time-mux mode, 1 for the rest")
+    parser.add_argument(
+        "--time-mux-random", action="store_true",
+        help="Give every time-mux slot to a random controller instead of "
+             "taking turns")
+    mode.add_argument(
+        "--select", type=parse_indices, metavar="C1,C2,...",
+        help="Pass through only the controllers with these numbers, in "
+             "this order")
+    mode.add_argument(
+        "--remap", type=parse_key_mapping, metavar="KEY=KEY,...",
+        help="Move keys to other keys, e.g. 1=2,2=1,3= swaps buttons 1 "
+             "and 2 and drops button 3. Keys are {}".format(
+                 ", ".join(KEY_NAMES)))
+    return mode
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Send gamepad inputs to remote hosts.")
+    parser.add_argument(
+        "hosts", nargs="+", type=parse_route,
+        metavar="REMOTE_HOST[=C1,C2,...]",
+        help="One or more addresses to send inputs to, optionally with "
+             "the virtual controllers sent to each one. Hosts get all "
+             "controllers by default.")
+    mode = add_mapper_arguments(parser)
+    mode.add_argument(
+        "--pipeline", metavar="FILE",
+        help="Chain the modes listed in a JSON file, see pipeline.example.json")
+    parser.add_argument(
+        "--multicast-ttl", type=int, default=MULTICAST_TTL, metavar="HOPS",
+        help="Number of routers multicast packets may cross "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--multicast-interface", metavar="IP",
+        help="Address of the interface to send multicast packets from "
+             "(default: chosen by the routing table)")
+    parser.add_argument(
+        "--broadcast", action="store_true",
+        help="Allow sending to broadcast addresses, such as the "
+             "broadcast address of the local subnet")
+    parser.add_argument(
+        "--ascii", action="store_true",
+        help="Send the legacy ASCII packets instead of binary ones")
+    parser.add_argument(
+        "--heartbeat-min", type=float, default=HEARTBEAT_MIN,
+        metavar="SECONDS",
+        help="Resend an unchanged state this soon after a change "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--heartbeat-max", type=float, default=HEARTBEAT_MAX,
+        metavar="SECONDS",
+        help="Longest interval between resends of an unchanged state. "
+             "Must be less than the --link-timeout of the receivers, or "
+             "they release held keys. (default: %(default)s)")
+    parser.add_argument(
+        "--log-level", choices=log.LEVELS, default="info",
+        help="Least important messages to show, debug shows every packet "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--log-rate", type=int, default=log.RATE, metavar="COUNT",
+        help="Most messages of the same kind to show per second "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--tick-rate", type=float, metavar="RATE",
+        help="Send at most RATE changes per second, folding all input in "
+             "between into one packet (default: send every change)")
+    return parser.parse_args(args)
+
+
+def parse_grouping(text):
+    if text == "balanced":
+        return vote.balanced_groups
+    if text == "round-robin":
+        return vote.round_robin_groups
+    return vote.explicit_groups(int(group) for group in text.split(","))
+
+
+def parse_slot_weights(text):
+    weights = [int(weight) for weight in text.split(",")]
+    if any(weight < 0 for weight in weights):
+        raise ValueError("Slot weights can't be negative")
+    return weights
+
+
+def parse_weights(text):
+    return [float(weight) for weight in text.split(",")]
+
+
+def parse_route(text):
+    host, _, controllers = text.partition("=")
+    if not controllers:
+        return host, None
+    return host, parse_indices(controllers)
+
+
+def parse_indices(text):
+    indices = [int(index) for index in text.split(",")]
+    if any(index < 0 for index in indices):
+        raise ValueError("Controller numbers can't be negative")
+    return indices
+
+
+def parse_key_mapping(text):
+    mapping = {}
+    for item in text.split(","):
+        key, _, target = item.partition("=")
+        mapping[1 << KEY_NAMES.index(key)] = \
+            1 << KEY_NAMES.index(target) if target else 0
+    return mapping
+
+
+# Mode options in the order they are checked in make_game_state_mapper
+MAPPER_MODES = ("democracy", "time_mux", "random", "select", "remap")
+
+
+def mapper_mode(options):
+    """Name of the mode chosen in options."""
+    for mode in MAPPER_MODES:
+        if getattr(options, mode) is not None:
+            return mode.replace("_", "-")
+    return "separate"
+
+
+def parse_stage(stage):
+    """Parse the options of one pipeline stage, given as a dict from the
+    option names without dashes to their values."""
+    args = []
+    for name, value in stage.items():
+        if value is False or value is None:
+            continue
+        args.append("--" + name)
+        if isinstance(value, list):
+            args.append(",".join(str(item) for item in value))
+        elif value is not True:
+            args.append(str(value))
+    parser = argparse.ArgumentParser(prog="pipeline stage")
+    add_mapper_arguments(parser)
+    return parser.parse_args(args)
+
+
+def check_heartbeat(options):
+    if options.heartbeat_min <= 0:
+        logger.error("--heartbeat-min must be positive, got %s",
+                     options.heartbeat_min)
+        sys.exit(1)
+    if options.heartbeat_min > options.heartbeat_max:
+        logger.error("--heartbeat-min can't be more than --heartbeat-max, "
+                     "got %s and %s", options.heartbeat_min,
+                     options.heartbeat_max)
+        sys.exit(1)
+    if options.heartbeat_max >= RECEIVER_LINK_TIMEOUT:
+        logger.warning("--heartbeat-max %s is not below the default "
+                       "receiver link timeout of %s seconds, start the "
+                       "receivers with a longer --link-timeout",
+                       options.heartbeat_max, RECEIVER_LINK_TIMEOUT)
+
+
+def make_pipeline(options):
+    """Build the pipeline of the --pipeline file, or a single stage of
+    the mode in options."""
+    if options.pipeline is None:
+        return Pipeline([(mapper_mode(options),
+                          make_game_state_mapper(options))])
     try:
-        rate = float(args[1])
-    except ValueError:
-        print("RATE is not a number, got", rate)
-        usage()
-    game_state_mapper = time_mux_controller(rate)
-    args = args[2:]
-
-if len(args) == 0:
-    usage()
-
-hosts = args
-socks = []
-for host in hosts:
+        stages = [parse_stage(stage) for stage in load_stages(
+            options.pipeline)]
+    except (OSError, ValueError) as error:
+        logger.error("%s", error)
+        sys.exit(1)
+    logger.info("Using a pipeline of %d stages", len(stages))
+    return Pipeline([(mapper_mode(stage), make_game_state_mapper(stage))
+                     for stage in stages])
+
+
+def make_game_state_mapper(options):
+    strategy = (options.vote_weights, options.vote_min, options.vote_quorum,
+                options.vote_window)
+    if options.democracy is None and \
+            (options.vote_engine is not None or
+             options.vote_groups is not None or
+             any(option is not None for option in strategy)):
+        logger.error("The --vote-* options require --democracy")
+        sys.exit(1)
+    if options.random is None and \
+            (options.random_seed is not None or options.random_no_repeat or
+             options.random_active is not None):
+        logger.error("The --random-* options require --random")
+        sys.exit(1)
+    if options.time_mux is None and \
+            (options.time_mux_weights is not None or options.time_mux_random):
+        logger.error("The --time-mux-* options require --time-mux")
+        sys.exit(1)
+    if options.democracy is not None:
+        logger.info("Using democracy mode")
+        if options.democracy < 1:
+            logger.error("NUMBER must be at least 1, got %d",
+                         options.democracy)
+            sys.exit(1)
+        if options.vote_groups is None:
+            options.vote_groups = vote.balanced_groups
+        try:
+            options.vote_groups(0, options.democracy)
+        except ValueError as error:
+            logger.error("%s", error)
+            sys.exit(1)
+        vote_engine = options.vote_engine
+        if vote_engine is None:
+            vote_engine = "loop"
+            if any(option is not None for option in strategy):
+                vote_engine = "weighted"
+        elif vote_engine != "weighted" and \
+                any(option is not None for option in strategy):
+            logger.error("The --vote-* options require --vote-engine "
+                         "weighted")
+            sys.exit(1)
+        if vote_engine == "weighted":
+            return vote.WeightedVote(
+                options.democracy,
+                weights=options.vote_weights,
+                min_votes=2 if options.vote_min is None else options.vote_min,
+                quorum=(options.vote_quorum or 0) / 100,
+                window=(options.vote_window or 0) / 1000,
+                grouping=options.vote_groups)
+        if vote_engine == "numpy":
+            if vote.numpy is None:
+                logger.error("The numpy vote engine requires NumPy to be "
+                             "installed")
+                sys.exit(1)
+            return vote.numpy_democratic_controller(options.democracy,
+                                                    options.vote_groups)
+        if vote_engine == "incremental":
+            return vote.incremental_democratic_controller(
+                options.democracy, options.vote_groups)
+        return one_democratic_controller(options.democracy,
+                                         options.vote_groups)
+    if options.time_mux is not None:
+        logger.info("Using time-based multiplexing")
+        if options.time_mux <= 0:
+            logger.error("RATE must be positive, got %s", options.time_mux)
+            sys.exit(1)
+        return time_mux_controller(options.time_mux,
+                                   weights=options.time_mux_weights,
+                                   randomize=options.time_mux_random)
+    if options.random is not None:
+        logger.info("Using random controller selection")
+        if options.random < 0:
+            logger.error("SECONDS can't be negative, got %s",
+                         options.random)
+            sys.exit(1)
+        active_window = None
+        if options.random_active is not None:
+            active_window = options.random_active / 1000
+        return random_controller(interval=options.random or None,
+                                 seed=options.random_seed,
+                                 no_repeat=options.random_no_repeat,
+                                 active_window=active_window)
+    if options.select is not None:
+        logger.info("Using controllers %s",
+                    ", ".join(map(str, options.select)))
+        return select_controllers(options.select)
+    if options.remap is not None:
+        logger.info("Remapping keys")
+        return remap_keys(options.remap)
+    return all_controllers_are_separate
+
+
+def open_socket(multicast_ttl=MULTICAST_TTL, multicast_interface=None,
+                broadcast=False):
+    """Open the unconnected socket every packet is sent from.
+
+    Destinations can also be multicast groups, which one packet reaches
+    every receiver that has joined, or with broadcast broadcast
+    addresses.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        port = 55555
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.connect((host, port))
-
-    except socket.gaierror:
-        print("Host {} not known".format(host))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                        multicast_ttl)
+        if multicast_interface is not None:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                            socket.inet_aton(multicast_interface))
+        if broadcast:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    except OSError as error:
+        logger.error("Can't set up the socket: %s", error)
         sys.exit(1)
-    socks.append(sock)
-print("Sending keys to the following endpoints:", ", ".join(hosts))
+    return sock
+
+
+def resolve(routes):
+    """Look up the hosts of (host, controllers) routes. Returns the
+    routes with an (address, port) destination in place of the host."""
+    destination_routes = []
+    for host, controllers in routes:
+        try:
+            port = 55555
+            address = socket.gethostbyname(host)
+        except socket.gaierror:
+            logger.error("Host %s not known", host)
+            sys.exit(1)
+        destination_routes.append(((address, port), controllers))
+    lines = ["Sending keys to the following endpoints:"]
+    for host, controllers in routes:
+        if controllers is None:
+            lines.append("{}: all controllers".format(host))
+        else:
+            lines.append("{}: controllers {}".format(
+                host, ", ".join(map(str, controllers))))
+    logger.info("%s", "\n".join(lines))
+    return destination_routes
+
 
+def axis_direction(value):
+    """Digitize an analog axis value into -1, 0 or 1."""
+    if value < 127:
+        return -1
+    elif value > 128:
+        return 1
+    return 0
 
-class GamepadReader(threading.Thread):
 
-    def __init__(self, events, gamepad):
-        super().__init__()
-        self.__events = events
-        self.__id, self.__gamepad = gamepad
+def update_game_state(game_state, controller, events):
+    """Apply gamepad events to the state of one controller. Returns True
+    if the state changed."""
+    changed = False
+    for event in events:
+        code = pack_event_code(event.raw_type, event.raw_code)
+        # PS1/2 gamepad with usb adapter
+        axis = AXIS_CODES.get(code)
+        if axis is not None:
+            if game_state.set_axis(controller, axis,
+                                   axis_direction(event.state)):
+                changed = True
+            continue
+        bit = BUTTON_CODES.get(code)
+        if bit is not None:
+            if game_state.set_button(controller, bit, event.state):
+                changed = True
+
+        # X360 USB
+        # ABS_HAT0X/Y are already -1, 0 or 1 and BTN_A... are buttons,
+        # add them to AXIS_CODES and BUTTON_CODES to support the pad.
+    return changed
+
+
+class MapperCache(object):
+    """Maps the game state into output bitmasks, reusing the previous
+    result while the input is the same.
+
+    The input is fingerprinted by the bitmask of every controller.
+    Mappers whose output also changes with time have a deadline()
+    method returning the next monotonic time it may change, or None,
+    and run again once it has passed. Every change to the game state
+    must also be reported with invalidate(): a tap that is pressed and
+    released between two maps leaves the same bitmasks behind, yet
+    mappers that follow the changes with listeners, like the vote
+    engines, may still have new output.
+    """
+
+    def __init__(self, mapper):
+        self.__mapper = mapper
+        self.__deadline = getattr(mapper, "deadline", None)
+        self.__fingerprint = None
+        self.__bitmasks = None
+
+    def map(self, game_state, now=None):
+        """Get the output bitmasks for the game state."""
+        fingerprint = game_state.bitmasks.tobytes()
+        if fingerprint != self.__fingerprint or self.due(now):
+            self.__fingerprint = fingerprint
+            self.__bitmasks = self.__mapper(game_state).bitmasks.tobytes()
+        return self.__bitmasks
+
+    def invalidate(self):
+        """Run the mapper on the next map even if the bitmasks are the
+        same."""
+        self.__fingerprint = None
+
+    def deadline(self):
+        """Monotonic time when the output changes next, or None."""
+        if self.__deadline is None:
+            return None
+        return self.__deadline()
+
+    def due(self, now=None):
+        """True if the deadline of the mapper has passed."""
+        deadline = self.deadline()
+        if deadline is None:
+            return False
+        return deadline <= (time.monotonic() if now is None else now)
+
+
+class Heartbeat(object):
+    """Schedule for resending an unchanged state.
+
+    The interval starts at min_interval after every change and doubles
+    after each heartbeat up to max_interval.
+    """
+
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.deadline = 0
+
+    def reset(self, now):
+        """Start over after the state has changed."""
+        self.interval = self.min_interval
+        self.deadline = now + self.interval
+
+    def beat(self, now):
+        """Schedule the next heartbeat after sending one."""
+        self.interval = min(self.interval * 2, self.max_interval)
+        self.deadline = now + self.interval
+
+    def timeout(self, now):
+        """Seconds until the next heartbeat is due."""
+        return max(0, self.deadline - now)
+
+
+class SendTick(object):
+    """Limits sending changes to once per tick.
+
+    Input that arrives before the tick is over is folded into the game
+    state and sent with the next tick. packets and events count the
+    changes sent and the input events they carried.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.deadline = 0
+        self.pending = False
+        self.packets = 0
+        self.events = 0
+
+    def ready(self, now):
+        """True if a pending change may be sent now."""
+        return self.pending and now >= self.deadline
+
+    def sent(self, now):
+        """Start the next tick after sending a change."""
+        self.deadline = now + self.interval
+        self.packets += 1
+
+    def report(self):
+        """Coalescing statistics as text."""
+        ratio = self.events / self.packets if self.packets else 0
+        return "Sent {} changes, {:.1f} events per change".format(
+            self.packets, ratio)
+
+
+def exit_on_signal(signum, frame):
+    sys.exit(0)
+
 
-    def run(self):
+def main():
+    options = parse_args(sys.argv[1:])
+    log.setup(options.log_level, options.log_rate)
+    check_heartbeat(options)
+    pipeline = make_pipeline(options)
+    fanout = FanOut(open_socket(options.multicast_ttl,
+                                options.multicast_interface,
+                                options.broadcast))
+
+    def send_payload(destinations, encoded_payload):
+        logger.debug("Sending %r", encoded_payload)
+        fanout.send(destinations, encoded_payload)
+
+    # Every destination gets only its own controllers
+    router = Router(resolve(options.hosts),
+                    LegacyEncoder if options.ascii else PacketEncoder,
+                    send_payload)
+
+    game_state = GameState(len(devices.gamepads))
+    lines = ["Using the following game controllers:"]
+    for gamepad_id, gamepad_device in enumerate(devices.gamepads):
+        lines.append("{}. {}".format(gamepad_id, gamepad_device))
+    logger.info("%s", "\n".join(lines))
+
+    tick = SendTick(options.tick_rate)
+    latency = LatencyStats()
+    # Kernel time of the newest input not sent yet, on the same wall
+    # clock as time.time_ns()
+    input_ns = None
+
+    def handle_events(gamepad_id, events):
+        nonlocal input_ns
+        tick.events += len(events)
+        event = events[-1]
+        event_ns = event.tv_sec * 1000000000 + event.tv_usec * 1000
+        latency.record("input to read", time.time_ns() - event_ns)
+        if not update_game_state(game_state, gamepad_id, events):
+            return False
+        mapped.invalidate()
+        if input_ns is None or event_ns > input_ns:
+            input_ns = event_ns
+        return True
+
+    def log_report():
+        logger.info("Stage timings:\n%s", pipeline.report())
+        logger.info("Latency:\n%s", latency.report())
+        logger.info("%s", reactor.report())
+        logger.info("%s", tick.report())
+        if fanout.errors:
+            logger.warning("Failed destinations:\n%s", fanout.report())
+
+    # The report is logged by the loop, not in the middle of whatever
+    # the signal interrupted
+    report_requested = False
+
+    def request_report(signum, frame):
+        nonlocal report_requested
+        report_requested = True
+
+    signal.signal(signal.SIGUSR1, request_report)
+
+    # One epoll loop reads all gamepads and updates the state in place
+    reactor = GamepadReactor(enumerate(devices.gamepads), handle_events)
+    heartbeat = Heartbeat(options.heartbeat_min, options.heartbeat_max)
+    mapped = MapperCache(pipeline)
+    sent_bitmasks = None
+    # Report on every way out: Ctrl-C, SIGTERM or a removed gamepad
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    try:
         while True:
+            now = time.monotonic()
+            timeout = heartbeat.timeout(now)
+            # A pending change is sent when its tick is over, otherwise
+            # wait for input or for the mapper output to change
+            deadline = tick.deadline if tick.pending else mapped.deadline()
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - now))
             try:
-                event = self.__gamepad.read()
-            except OSError:
-                print("Gamepad removed, exiting.")
+                if reactor.poll(timeout):
+                    tick.pending = True
+            except (OSError, UnpluggedError):
+                logger.error("Gamepad removed, exiting.")
                 sys.exit(1)
-            self.__events.put((self.__id, event))
-
-
-game_state = []
-game_state_changed = False
-
-event_queue = queue.Queue()
-print("Using the following game controllers:")
-for gamepad in enumerate(devices.gamepads):
-    gamepad_id, gamepad_device = gamepad
-    game_state.append({
-        "X": 0,
-        "Y": 0,
-        "1": 0,
-        "2": 0,
-        "3": 0,
-        "4": 0,
-    })
-    print("{}. {}".format(gamepad_id, gamepad_device))
-    GamepadReader(event_queue, gamepad).start()
-
-while True:
-    force_resend = False
-    try:
-        gid, events = event_queue.get(block=True, timeout=0.05)
+
+            now = time.monotonic()
+            heartbeat_due = now >= heartbeat.deadline
+            if mapped.due(now):
+                tick.pending = True
+            if report_requested:
+                report_requested = False
+                log_report()
+            sent_change = False
+            sent_input_ns = None
+            if tick.ready(now):
+                tick.pending = False
+                start_ns = time.perf_counter_ns()
+                bitmasks = mapped.map(game_state, now)
+                latency.record("map", time.perf_counter_ns() - start_ns)
+                if bitmasks != sent_bitmasks:
+                    # Send changes once per tick and heartbeat quickly after
+                    heartbeat.reset(now)
+                    tick.sent(now)
+                    start_ns = time.perf_counter_ns()
+                    router.update(bitmasks, input_ns)
+                    latency.record("encode", time.perf_counter_ns() - start_ns)
+                    sent_bitmasks = bitmasks
+                    sent_change = True
+                    sent_input_ns = input_ns
+                    heartbeat_due = False
+                input_ns = None
+            if heartbeat_due:
+                heartbeat.beat(now)
+                if sent_bitmasks is None:
+                    sent_bitmasks = mapped.map(game_state)
+                    router.update(sent_bitmasks)
+                else:
+                    router.repeat()
+            # Send all packets of this round at once. Failing destinations
+            # are counted and don't hold up the others.
+            start_ns = time.perf_counter_ns()
+            for address, port in fanout.flush():
+                logger.warning("Sending to %s:%d failed: %s", address, port,
+                               fanout.last_errors[(address, port)])
+            if sent_change:
+                latency.record("send", time.perf_counter_ns() - start_ns)
+            if sent_input_ns is not None:
+                latency.record("input to sent", time.time_ns() - sent_input_ns)
+
     except KeyboardInterrupt:
         sys.exit(0)
-    except queue.Empty:
-        force_resend = True
-        events = []
-
-    for event in events:
-        force_resend = True
-        # PS1/2 gamepad with usb adapter
-        if event.code == "ABS_X":
-            if event.state < 127:
-                game_state[gid]["X"] = -1
-            elif event.state > 128:
-                game_state[gid]["X"] = 1
-            else:
-                game_state[gid]["X"] = 0
-        elif event.code == "ABS_Y":
-            if event.state < 127:
-                game_state[gid]["Y"] = -1
-            elif event.state > 128:
-                game_state[gid]["Y"] = 1
-            else:
-                game_state[gid]["Y"] = 0
-        elif event.code == "BTN_TOP":
-            game_state[gid]["1"] = event.state
-        elif event.code == "BTN_THUMB2":
-            game_state[gid]["2"] = event.state
-        elif event.code == "BTN_THUMB":
-            game_state[gid]["3"] = event.state
-        elif event.code == "BTN_BASE3":
-            game_state[gid]["4"] = event.state
+    finally:
+        log_report()
 
-        # X360 USB
-        # elif event.code.startswith("ABS_HAT0"):
-        #     axis, direction = event.code[8], event.state
-        #     game_state[gid][axis] = int(direction)
-        # elif event.code.startswith("BTN_"):
-        #     button, state = event.code[4], event.state
-        #     print(button, state)
-        #     game_state[gid][button] = int(state)
-       
-        else:
-            # print(gid, event.code, event.state)
-            force_resend = False
-
-    if force_resend:
-        sent_game_state = game_state_mapper(game_state)
-        # print(sent_game_state)
-        game_state_payload = ""
-        # print("F", sent_game_state)
-        for controller in sent_game_state:
-            # print("C", controller)
-            key_vector = list("00000000")
-            #                  UDLRABCD
-            if controller["Y"] < 0:
-                key_vector[0] = "1"
-            if controller["Y"] > 0:
-                key_vector[1] = "1"
-            if controller["X"] < 0:
-                key_vector[2] = "1"
-            if controller["X"] > 0:
-                key_vector[3] = "1"
-            if controller["1"] == 1:
-                key_vector[4] = "1"
-            if controller["2"] == 1:
-                key_vector[5] = "1"
-            if controller["3"] == 1:
-                key_vector[6] = "1"
-            if controller["4"] == 1:
-                key_vector[7] = "1"
-            game_state_payload += "".join(key_vector)
-
-        encoded_payload = game_state_payload.encode("ascii")
-        print(encoded_payload)
-        try:
-            # TODO: Add multicast / broadcast support
-            for sock in socks:
-                sock.send(encoded_payload)
-        except ConnectionRefusedError:
-            # Keep retrying
-            pass
-        force_resend = False
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""Vote engines for mapping many real controllers into a few virtual ones.
+
+These give the same results as one_democratic_controller in send.py,
+but scale better with the number of voters.
+
+Every engine takes a grouping, a function called as
+grouping(number_of_voters, number_of_groups) that returns the group of
+each voter, or -1 for voters that don't vote. The table is only built
+again when the number of voters changes.
+"""
+
+import time
+
+from gamestate import GameState, AXES, BUTTON_BITS, CHANNELS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Value of each output bit from the clamped channels: U, D, L, R come
+# from the sign of Y and X, the buttons from the button channels.
+_BIT_WEIGHTS = (1 << 0, 1 << 1, 1 << 2, 1 << 3) + BUTTON_BITS
+
+
+def balanced_groups(number_of_voters, number_of_groups):
+    """Split the voters into consecutive groups whose sizes differ by at
+    most one. With fewer voters than groups some groups stay empty."""
+    return [voter * number_of_groups // number_of_voters
+            for voter in range(number_of_voters)]
+
+
+def round_robin_groups(number_of_voters, number_of_groups):
+    """Deal the voters into the groups in turn."""
+    return [voter % number_of_groups for voter in range(number_of_voters)]
+
+
+def explicit_groups(assignment):
+    """Grouping that puts voter i into group assignment[i]. Voters
+    beyond the end of the assignment don't vote."""
+    assignment = list(assignment)
+
+    def grouping(number_of_voters, number_of_groups):
+        for group in assignment:
+            if not -1 <= group < number_of_groups:
+                raise ValueError("There is no group %d" % group)
+        groups = assignment[:number_of_voters]
+        groups.extend([-1] * (number_of_voters - len(groups)))
+        return groups
+
+    return grouping
+
+
+def numpy_democratic_controller(number_of_virtual_controllers,
+                                grouping=balanced_groups):
+    """Majority vote of all voters as one batched NumPy operation.
+
+    The voters are viewed as an N x channels array, the groups are
+    summed with one multiplication by a one-hot group matrix, and all
+    sums are thresholded at once.
+    """
+    if numpy is None:
+        raise RuntimeError("The NumPy vote engine requires numpy")
+
+    democratic_game_state = GameState(number_of_virtual_controllers)
+    # Views that write straight into the output game state
+    democratic_axes = numpy.frombuffer(
+        democratic_game_state.axes, dtype=numpy.int8).reshape(-1, AXES)
+    democratic_bitmasks = numpy.frombuffer(
+        democratic_game_state.bitmasks, dtype=numpy.uint8)
+    weights = numpy.array(_BIT_WEIGHTS, dtype=numpy.uint8)
+    button_bits = numpy.array(BUTTON_BITS, dtype=numpy.uint8)
+    # groups x voters matrix with a one where the voter is in the group
+    group_matrix = numpy.zeros((number_of_virtual_controllers, 0),
+                               dtype=numpy.int32)
+
+    def mapper(full_game_state):
+        nonlocal group_matrix
+        voters = len(full_game_state)
+        if group_matrix.shape[1] != voters:
+            groups = numpy.array(
+                grouping(voters, number_of_virtual_controllers),
+                dtype=numpy.intp).reshape(voters)
+            group_matrix = (
+                numpy.arange(number_of_virtual_controllers)[:, None] ==
+                groups).astype(numpy.int32)
+
+        axes = numpy.frombuffer(full_game_state.axes, dtype=numpy.int8)
+        axes = axes.reshape(voters, AXES)
+        bitmasks = numpy.frombuffer(full_game_state.bitmasks,
+                                    dtype=numpy.uint8)
+        buttons = (bitmasks[:, None] & button_bits) != 0
+
+        # Sum inputs of each group
+        axis_sums = group_matrix @ axes.astype(numpy.int32)
+        button_sums = group_matrix @ buttons.astype(numpy.int32)
+
+        # Filter inputs with only one supporter
+        axis_votes = (axis_sums > 1).astype(numpy.int8) - (axis_sums < -1)
+        pressed = button_sums > 1
+        bits = numpy.concatenate((
+            axis_votes[:, 1:2] < 0, axis_votes[:, 1:2] > 0,
+            axis_votes[:, 0:1] < 0, axis_votes[:, 0:1] > 0,
+            pressed), axis=1)
+
+        bitmasks = (bits * weights).sum(axis=1, dtype=numpy.uint8)
+        if democratic_game_state.listeners:
+            # Go through the game state so that the listeners hear
+            for group, bitmask in enumerate(bitmasks.tolist()):
+                democratic_game_state.set_bitmask(group, bitmask)
+        else:
+            democratic_axes[:] = axis_votes
+            democratic_bitmasks[:] = bitmasks
+        return democratic_game_state
+
+    return mapper
+
+
+def incremental_democratic_controller(number_of_virtual_controllers,
+                                      grouping=balanced_groups):
+    """Majority vote kept up to date one change at a time.
+
+    The mapper attaches itself as a listener of the real game state
+    and keeps a running tally of every channel of every group. A change
+    updates one tally and re-thresholds only that channel, so the cost
+    does not depend on the number of voters.
+    """
+    democratic_game_state = GameState(number_of_virtual_controllers)
+    tallies = [0] * (number_of_virtual_controllers * CHANNELS)
+    source = None
+    groups = []
+
+    def apply(group, channel):
+        tally = tallies[group * CHANNELS + channel]
+        if channel < AXES:
+            # Filter inputs with only one supporter
+            if tally < -1:
+                value = -1
+            elif tally > 1:
+                value = 1
+            else:
+                value = 0
+            democratic_game_state.set_axis(group, channel, value)
+        else:
+            democratic_game_state.set_button(
+                group, BUTTON_BITS[channel - AXES], tally > 1)
+
+    def on_change(controller, channel, old_value, new_value):
+        group = groups[controller]
+        if group < 0:
+            return
+        tallies[group * CHANNELS + channel] += new_value - old_value
+        apply(group, channel)
+
+    def attach(full_game_state):
+        nonlocal source, groups
+        source = full_game_state
+        if len(groups) != len(full_game_state):
+            groups = grouping(len(full_game_state),
+                              number_of_virtual_controllers)
+        for index in range(len(tallies)):
+            tallies[index] = 0
+        for controller_number, group in enumerate(groups):
+            if group < 0:
+                continue
+            group_tallies = group * CHANNELS
+            channels = full_game_state.get_channels(controller_number)
+            for channel, value in enumerate(channels):
+                tallies[group_tallies + channel] += value
+        for group in range(number_of_virtual_controllers):
+            for channel in range(CHANNELS):
+                apply(group, channel)
+        full_game_state.listeners.append(on_change)
+
+    def mapper(full_game_state):
+        if full_game_state is not source or \
+                on_change not in full_game_state.listeners:
+            attach(full_game_state)
+        return democratic_game_state
+
+    return mapper
+
+
+class _ExpiryRing(object):
+    """Ring buffer of votes waiting to expire, oldest first.
+
+    The window is the same for every vote, so expiry times are pushed
+    in increasing order and only the head ever needs to be checked.
+    """
+
+    def __init__(self, capacity=64):
+        self.__times = [0.0] * capacity
+        self.__entries = [None] * capacity
+        self.__head = 0
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def push(self, expires, entry):
+        """Add a vote that expires at the given time."""
+        capacity = len(self.__times)
+        if self.__count == capacity:
+            # Unroll into a ring twice the size
+            order = [(self.__head + i) % capacity for i in range(capacity)]
+            self.__times = [self.__times[i] for i in order] + \
+                [0.0] * capacity
+            self.__entries = [self.__entries[i] for i in order] + \
+                [None] * capacity
+            self.__head = 0
+            capacity *= 2
+        tail = (self.__head + self.__count) % capacity
+        self.__times[tail] = expires
+        self.__entries[tail] = entry
+        self.__count += 1
+
+    def first(self):
+        """Expiry time of the oldest vote, or None if empty."""
+        if not self.__count:
+            return None
+        return self.__times[self.__head]
+
+    def pop(self):
+        """Remove and return the oldest vote."""
+        entry = self.__entries[self.__head]
+        self.__entries[self.__head] = None
+        self.__head = (self.__head + 1) % len(self.__times)
+        self.__count -= 1
+        return entry
+
+
+class WeightedVote(object):
+    """Configurable majority vote for democracy mode.
+
+    weights   vote weight of each voter, 1 for voters not listed
+    min_votes weight a channel needs to win; 2 gives the classic "at
+              least two supporters" rule
+    quorum    fraction of the weight of the group's active voters that
+              a channel needs to win, on top of min_votes
+    window    seconds a vote keeps counting after it was released
+
+    A voter is active while any of its votes counts. Like the
+    incremental engine this keeps running tallies updated through the
+    game state listener, and expired votes are tracked in a ring
+    buffer, so the cost per event does not depend on the number of
+    voters.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, number_of_virtual_controllers, weights=None,
+                 min_votes=2, quorum=0.0, window=0.0,
+                 grouping=balanced_groups):
+        self.__groups = number_of_virtual_controllers
+        self.__grouping = grouping
+        self.__voter_groups = []
+        self.__weights = list(weights or ())
+        self.__min_votes = min_votes
+        self.__quorum = quorum
+        self.__window = window
+        self.__output = GameState(number_of_virtual_controllers)
+        self.__source = None
+        self.__tallies = [0] * (number_of_virtual_controllers * CHANNELS)
+        self.__active_weight = [0] * number_of_virtual_controllers
+        # Per voter and channel: the vote that counts and a generation
+        # that tells whether a pending expiry is still current
+        self.__votes = []
+        self.__generations = []
+        self.__counting = []
+        self.__expiring = _ExpiryRing()
+
+    def weight(self, controller):
+        """Vote weight of a real controller."""
+        if controller < len(self.__weights):
+            return self.__weights[controller]
+        return 1
+
+    def deadline(self):
+        """Monotonic time when the next vote expires, or None."""
+        return self.__expiring.first()
+
+    def __call__(self, full_game_state):
+        if full_game_state is not self.__source or \
+                self.__on_change not in full_game_state.listeners:
+            self.__attach(full_game_state)
+        self.__expire(time.monotonic())
+        return self.__output
+
+    def __attach(self, full_game_state):
+        self.__source = full_game_state
+        voters = len(full_game_state)
+        if len(self.__voter_groups) != voters:
+            self.__voter_groups = self.__grouping(voters, self.__groups)
+        self.__votes = [0] * (voters * CHANNELS)
+        self.__generations = [0] * (voters * CHANNELS)
+        self.__counting = [0] * voters
+        self.__expiring = _ExpiryRing()
+        for index in range(len(self.__tallies)):
+            self.__tallies[index] = 0
+        for group in range(self.__groups):
+            self.__active_weight[group] = 0
+        for controller in range(voters):
+            channels = full_game_state.get_channels(controller)
+            for channel, value in enumerate(channels):
+                if value:
+                    self.__set_vote(controller, channel, value)
+        for group in range(self.__groups):
+            self.__apply(group)
+        full_game_state.listeners.append(self.__on_change)
+
+    def __group(self, controller):
+        group = self.__voter_groups[controller]
+        return None if group < 0 else group
+
+    def __set_vote(self, controller, channel, value):
+        """Change the vote that counts. Returns its group or None."""
+        group = self.__group(controller)
+        index = controller * CHANNELS + channel
+        old_value = self.__votes[index]
+        if old_value == value or group is None:
+            self.__votes[index] = value
+            return group
+        self.__votes[index] = value
+        weight = self.weight(controller)
+        self.__tallies[group * CHANNELS + channel] += \
+            weight * (value - old_value)
+        # Keep track of which voters are active
+        if not old_value:
+            self.__counting[controller] += 1
+            if self.__counting[controller] == 1:
+                self.__active_weight[group] += weight
+        elif not value:
+            self.__counting[controller] -= 1
+            if not self.__counting[controller]:
+                self.__active_weight[group] -= weight
+        return group
+
+    def __on_change(self, controller, channel, old_value, new_value):
+        index = controller * CHANNELS + channel
+        self.__generations[index] += 1
+        if new_value or not self.__window:
+            group = self.__set_vote(controller, channel, new_value)
+        else:
+            # A released vote keeps counting until the window is over
+            self.__expiring.push(
+                time.monotonic() + self.__window,
+                (controller, channel, self.__generations[index]))
+            group = None
+        if group is not None:
+            self.__apply(group)
+
+    def __expire(self, now):
+        expiring = self.__expiring
+        while expiring and expiring.first() <= now:
+            controller, channel, generation = expiring.pop()
+            index = controller * CHANNELS + channel
+            if generation != self.__generations[index]:
+                # Pressed again since the release
+                continue
+            group = self.__set_vote(controller, channel, 0)
+            if group is not None:
+                self.__apply(group)
+
+    def __apply(self, group):
+        """Threshold the tallies of a group into the output."""
+        needed = max(self.__min_votes,
+                     self.__quorum * self.__active_weight[group])
+        tallies = self.__tallies
+        first = group * CHANNELS
+        for channel in range(CHANNELS):
+            tally = tallies[first + channel]
+            if channel < AXES:
+                if tally <= -needed:
+                    value = -1
+                elif tally >= needed:
+                    value = 1
+                else:
+                    value = 0
+                self.__output.set_axis(group, channel, value)
+            else:
+                self.__output.set_button(
+                    group, BUTTON_BITS[channel - AXES], tally >= needed)